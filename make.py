@@ -6,6 +6,7 @@ OS X, and Windows once the computer environment is setup.
 
 import os
 import sys
+import concurrent.futures
 import uuid
 import json
 import shutil
@@ -16,8 +17,20 @@ import unittest
 import urllib3
 urllib3.disable_warnings()
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 
+# paramiko is optional. It is only used by install() when
+# dev_client_use_sftp is set in sdk_settings.ini.
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+# The host OS does not change while running so check it once.
+_IS_WIN = sys.platform == 'win32'
+_IS_MAC = sys.platform == 'darwin'
+
 # These will be set in init() by using the sdk_settings.ini file.
 # They are used by various functions in the file.
 g_app_name = ''
@@ -25,36 +38,73 @@ g_app_uuid = ''
 g_dev_client_ip = ''
 g_dev_client_username = ''
 g_dev_client_password = ''
-g_python_cmd = 'python3'  # Default for Linux and OS X
+g_dev_client_use_sftp = False
+g_python_cmd = 'python' if _IS_WIN else 'python3'
+
+# The HTTP Auth chosen by get_auth(). It is set on the first call
+# and cleared if the NCOS device rejects it.
+_g_auth_cache = None
+
+# A single session is used for all NCOS API calls so the connection
+# to the NCOS device is kept alive between calls.
+_session = requests.Session()
+_session.verify = False
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
 
 # Returns the proper HTTP Auth for the global username and password.
 # Digest Auth is used for NCOS 6.4 and below while Basic Auth is
-# used for NCOS 6.5 and up.
+# used for NCOS 6.5 and up. The result is cached so the NCOS device
+# is only probed once.
 def get_auth():
+    global _g_auth_cache
     from http import HTTPStatus
 
-    use_basic = False
+    if _g_auth_cache is not None:
+        return _g_auth_cache
+
     device_api = 'https://{}/api/status/product_info'.format(g_dev_client_ip)
+    basic_auth = requests.auth.HTTPBasicAuth(g_dev_client_username, g_dev_client_password)
 
     try:
-        response = requests.get(device_api, auth=requests.auth.HTTPBasicAuth(g_dev_client_username, g_dev_client_password), verify=False)
-        if response.status_code == HTTPStatus.OK:
-            use_basic = True
+        # A HEAD request is enough to see if Basic Auth is accepted and the
+        # short timeout keeps a slow NCOS device from blocking the caller.
+        response = _session.head(device_api, auth=basic_auth, timeout=(2, 2))
+        if response.status_code not in (HTTPStatus.OK, HTTPStatus.UNAUTHORIZED):
+            # HEAD is not supported so probe with GET instead.
+            response = _session.get(device_api, auth=basic_auth, timeout=(2, 2))
+        use_basic = response.status_code == HTTPStatus.OK
 
     except:
-        use_basic = False
+        # The probe failed so use Digest Auth for this call but do not
+        # cache it. The next call will probe the NCOS device again.
+        _session.auth = requests.auth.HTTPDigestAuth(g_dev_client_username, g_dev_client_password)
+        return _session.auth
 
     if use_basic:
-        return requests.auth.HTTPBasicAuth(g_dev_client_username, g_dev_client_password)
+        _g_auth_cache = basic_auth
     else:
-        return requests.auth.HTTPDigestAuth(g_dev_client_username, g_dev_client_password)
+        _g_auth_cache = requests.auth.HTTPDigestAuth(g_dev_client_username, g_dev_client_password)
+
+    _session.auth = _g_auth_cache
+    return _g_auth_cache
+
+
+# Clears the cached HTTP Auth if the NCOS device rejected it so
+# the next call probes the device again.
+def check_auth(response):
+    global _g_auth_cache
+    from http import HTTPStatus
+
+    if response.status_code == HTTPStatus.UNAUTHORIZED:
+        _g_auth_cache = None
+        _session.auth = None
 
 
 # Returns boolean to indicate if the NCOS device is
 # in DEV mode
 def is_NCOS_device_in_DEV_mode():
-    sdk_status = json.loads(get('/status/system/sdk')).get('data')
+    sdk_status = get('/status/system/sdk').get('data')
     if sdk_status.get('mode') in ['devmode', 'standard']:
         return True if sdk_status.get('mode') == 'devmode' else False
     raise('Unknown SDK mode (%s)' % sdk_status.get('mode'))
@@ -73,29 +123,30 @@ def get(config_tree):
     ncos_api = 'https://{}/api{}'.format(g_dev_client_ip, config_tree)
 
     try:
-        response = requests.get(ncos_api, auth=get_auth(), verify=False)
+        get_auth()
+        response = _session.get(ncos_api)
+        check_auth(response)
 
     except (requests.exceptions.Timeout,
             requests.exceptions.ConnectionError) as ex:
         print("Error with get for NCOS device at {}. Exception: {}".format(g_dev_client_ip, ex))
         return None
 
-    return json.dumps(json.loads(response.text), indent=4)
+    return response.json()
 
 
 # Get a list of all the apps in the directory
-def get_app_list():
+def get_app_list(cwd=None):
     app_dirs = []
-    cwd = os.getcwd()
+    if cwd is None:
+        cwd = os.getcwd()
     print("Scanning {} for app directories.".format(cwd))
-    dirs_in_cwd = os.listdir(cwd)
 
     # Assume dir is an app_dir if it contains 'package.ini'
-    for item in dirs_in_cwd:
-        if os.path.isdir(item):
-            contents = os.listdir(item)
-            if 'package.ini' in contents:
-                app_dirs.append(item)
+    with os.scandir(cwd) as it:
+        for entry in it:
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, 'package.ini')):
+                app_dirs.append(entry.name)
 
     return app_dirs
 
@@ -103,11 +154,11 @@ def get_app_list():
 # Puts an SDK action in the NCOS device config store
 def put(value):
     try:
-        response = requests.put("https://{}/api/control/system/sdk/action".format(g_dev_client_ip),
+        get_auth()
+        response = _session.put("https://{}/api/control/system/sdk/action".format(g_dev_client_ip),
                                 headers={"Content-Type": "application/x-www-form-urlencoded"},
-                                auth=get_auth(),
-                                data={"data": '"{} {}"'.format(value, get_app_uuid())},
-                                verify=False)
+                                data={"data": '"{} {}"'.format(value, get_app_uuid())})
+        check_auth(response)
 
         print('status_code: {}'.format(response.status_code))
 
@@ -116,14 +167,16 @@ def put(value):
         print("Error with put for NCOS device at {}. Exception: {}".format(g_dev_client_ip, ex))
         return None
 
-    return json.dumps(json.loads(response.text), indent=4)
+    return response.json()
 
 
 # Cleans the SDK directory for a given app by removing files created during packaging.
-def clean(app=None):
+def clean(app=None, cwd=None):
     app_name = g_app_name
     if app is not None:
         app_name = app
+    if cwd is None:
+        cwd = os.getcwd()
     print("Cleaning {}".format(app_name))
     app_pack_name = get_app_pack(app_name)
     try:
@@ -135,14 +188,14 @@ def clean(app=None):
     except OSError as e:
         print('Clean Error 1 for file {}: {}'.format(app_pack_name, e))
 
-    meta_dir = '{}/{}/METADATA'.format(os.getcwd(), app_name)
+    meta_dir = '{}/{}/METADATA'.format(cwd, app_name)
     try:
         if os.path.isdir(meta_dir):
             shutil.rmtree(meta_dir)
     except OSError as e:
         print('Clean Error 2 for directory {}: {}'.format(meta_dir, e))
 
-    build_file = os.path.join(os.getcwd(), '.build')
+    build_file = os.path.join(cwd, '.build')
     try:
         if os.path.isfile(build_file):
             os.remove(build_file)
@@ -153,58 +206,44 @@ def clean(app=None):
 # Cleans the SDK directory for all apps by removing files created during packaging.
 def clean_all():
     cwd = os.getcwd()
-    print("Scanning {} for app directories.".format(cwd))
-    app_dirs = get_app_list()
+    app_dirs = get_app_list(cwd)
 
     for app in app_dirs:
-        clean(app)
-
+        clean(app, cwd)
 
-def scan_for_cr(path):
-    scanfiles = ('.py', '.sh')
-    for root, _, files in os.walk(path):
-        for fl in files:
-            with open(os.path.join(root, fl), 'rb') as f:
-                if b'\r' in f.read() and [x for x in scanfiles if fl.endswith(x)]:
-                    raise Exception('Carriage return (\\r) found in file %s' % (os.path.join(root, fl)))
 
 # Package the app files into a tar.gz archive.
-def package():
-    print("Packaging {}".format(g_app_name))
+def package(app=None):
+    app_name = g_app_name
+    if app is not None:
+        app_name = app
+    print("Packaging {}".format(app_name))
     success = True
-    package_dir = os.path.join('tools', 'bin')
     package_script_path = os.path.join('tools', 'bin', 'package_application.py')
-    app_path = os.path.join(g_app_name)
-    scan_for_cr(app_path)
+    app_path = os.path.join(app_name)
 
     try:
-        subprocess.check_output('{} {} {}'.format(g_python_cmd, package_script_path, app_path), shell=True)
-    except subprocess.CalledProcessError as err:
-        print('Error packaging {}: {}'.format(g_app_name, err))
+        subprocess.check_output([g_python_cmd, package_script_path, app_path])
+    except (subprocess.CalledProcessError, OSError) as err:
+        # OSError is raised if g_python_cmd can not be run.
+        print('Error packaging {}: {}'.format(app_name, err))
         success = False
     finally:
         return success
 
 
 # Package all the app files in the directory into a tar.gz archives.
+# Each app is packaged by its own package_application.py process so
+# the apps are packaged in parallel.
 def package_all():
-    success = True
-    cwd = os.getcwd()
-    print("Scanning {} for app directories.".format(cwd))
     app_dirs = get_app_list()
+    if not app_dirs:
+        return True
 
-    package_script_path = os.path.join('tools', 'bin', 'package_application.py')
-    for app in app_dirs:
-        app_path = os.path.join(app)
-        scan_for_cr(app_path)
-        try:
-            print('Build app: {}'.format(app_path))
-            subprocess.check_output('{} {} {}'.format(g_python_cmd, package_script_path, app_path), shell=True)
-        except subprocess.CalledProcessError as err:
-            print('Error packaging {}: {}'.format(app_path, err))
-            success = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(app_dirs), os.cpu_count() or 1)) as ex:
+        results = list(ex.map(package, app_dirs))
 
-    return success
+    return all(results)
 
 
 # Get the SDK status from the NCOS device
@@ -212,7 +251,43 @@ def status():
     status_tree = '/status/system/sdk'
     print('Get {} status for NCOS device at {}'.format(status_tree, g_dev_client_ip))
     response = get(status_tree)
-    print(response)
+    print(json.dumps(response, indent=4))
+
+
+# Upload the app tar.gz package to the NCOS device over SFTP. Returns
+# False if the SFTP session could not be opened so scp can be used instead.
+def sftp_install(app_archive):
+    ssh_client = paramiko.SSHClient()
+    # Same as StrictHostKeyChecking=no for sshpass.
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    try:
+        ssh_client.connect(g_dev_client_ip, username=g_dev_client_username, password=g_dev_client_password,
+                           look_for_keys=False, allow_agent=False)
+        sftp_client = ssh_client.open_sftp()
+    except (paramiko.SSHException, OSError) as ex:
+        print('Unable to open SFTP session to NCOS device {}, using scp instead. Exception: {}'.format(g_dev_client_ip, ex))
+        ssh_client.close()
+        return False
+
+    archive_size = os.path.getsize(app_archive)
+    sent = [0]
+
+    def progress(transferred, total):
+        sent[0] = transferred
+
+    try:
+        # Do not stat() /app_upload afterwards, the NCOS device may have
+        # already dropped the connection.
+        sftp_client.put(app_archive, '/app_upload', callback=progress, confirm=False)
+    except (paramiko.SSHException, EOFError, OSError) as ex:
+        # The NCOS device will drop the connection once it has the whole upload.
+        if sent[0] < archive_size:
+            print('Error installing {} in NCOS device {}: {}'.format(app_archive, g_dev_client_ip, ex))
+    finally:
+        ssh_client.close()
+
+    return True
 
 
 # Transfer the app app tar.gz package to the NCOS device
@@ -220,27 +295,34 @@ def install():
     if is_NCOS_device_in_DEV_mode():
         app_archive = get_app_pack()
 
+        if g_dev_client_use_sftp:
+            if paramiko is None:
+                print('WARNING: paramiko is not installed, using scp instead of SFTP.')
+            else:
+                print('Installing {} in NCOS device {} over SFTP.'.format(app_archive, g_dev_client_ip))
+                if sftp_install(app_archive):
+                    return 0
+
+        destination = '{}@{}:/app_upload'.format(g_dev_client_username, g_dev_client_ip)
+
         # Use sshpass for Linux or OS X
-        cmd = 'sshpass -p {0} scp -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no {1} {2}@{3}:/app_upload'.format(
-               g_dev_client_password, app_archive,
-               g_dev_client_username, g_dev_client_ip)
+        cmd = ['sshpass', '-p', g_dev_client_password, 'scp',
+               '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+               app_archive, destination]
 
         # For Windows, use pscp.exe in the tools directory
-        if sys.platform == 'win32':
-            cmd = "./tools/bin/pscp.exe -pw {0} -v {1} {2}@{3}:/app_upload".format(
-                   g_dev_client_password, app_archive,
-                   g_dev_client_username, g_dev_client_ip)
+        if _IS_WIN:
+            cmd = ['./tools/bin/pscp.exe', '-pw', g_dev_client_password, '-v', app_archive, destination]
 
         print('Installing {} in NCOS device {}.'.format(app_archive, g_dev_client_ip))
         try:
-            if sys.platform == 'win32':
-                subprocess.check_output(cmd)
-            else:
-                subprocess.check_output(cmd, shell=True)
+            subprocess.check_output(cmd)
         except subprocess.CalledProcessError as err:
             # There is always an error because the NCOS device will drop the connection.
             # print('Error installing: {}'.format(err))
             return 0
+        except OSError as err:
+            print('ERROR: Unable to run {} to install the app: {}'.format(cmd[0], err))
     else:
         print('ERROR: NCOS device is not in DEV Mode! Unable to install the app into {}.'.format(g_dev_client_ip))
 
@@ -251,7 +333,7 @@ def start():
         print('Start application {} for NCOS device at {}'.format(g_app_name, g_dev_client_ip))
         print('Application UUID is {}.'.format(g_app_uuid))
         response = put('start')
-        print(response)
+        print(json.dumps(response, indent=4))
     else:
         print('ERROR: NCOS device is not in DEV Mode! Unable to start the app from {}.'.format(g_dev_client_ip))
 
@@ -262,7 +344,7 @@ def stop():
         print('Stop application {} for NCOS device at {}'.format(g_app_name, g_dev_client_ip))
         print('Application UUID is {}.'.format(g_app_uuid))
         response = put('stop')
-        print(response)
+        print(json.dumps(response, indent=4))
     else:
         print('ERROR: NCOS device is not in DEV Mode! Unable to stop the app from {}.'.format(g_dev_client_ip))
 
@@ -273,7 +355,7 @@ def uninstall():
         print('Uninstall application {} for NCOS device at {}'.format(g_app_name, g_dev_client_ip))
         print('Application UUID is {}.'.format(g_app_uuid))
         response = put('uninstall')
-        print(response)
+        print(json.dumps(response, indent=4))
     else:
         print('ERROR: NCOS device is not in DEV Mode! Unable to uninstall the app from {}.'.format(g_dev_client_ip))
 
@@ -284,7 +366,7 @@ def purge():
         print('Purged application {} for NCOS device at {}'.format(g_app_name, g_dev_client_ip))
         print('Application UUID is {}.'.format(g_app_uuid))
         response = put('purge')
-        print(response)
+        print(json.dumps(response, indent=4))
     else:
         print('ERROR: NCOS device is not in DEV Mode! Unable to purge the app from {}.'.format(g_dev_client_ip))
 
@@ -343,11 +425,11 @@ def get_app_uuid(ceate_new_uuid=False):
 
 # Setup all the globals based on the OS and the sdk_settings.ini file.
 def init(ceate_new_uuid):
-    global g_python_cmd
     global g_app_name
     global g_dev_client_ip
     global g_dev_client_username
     global g_dev_client_password
+    global g_dev_client_use_sftp
 
     success = True
 
@@ -357,11 +439,9 @@ def init(ceate_new_uuid):
     ip_key = 'dev_client_ip'
     username_key = 'dev_client_username'
     password_key = 'dev_client_password'
+    sftp_key = 'dev_client_use_sftp'  # Optional
 
-    if sys.platform == 'win32':
-        g_python_cmd = 'python'
-
-    elif sys.platform == 'Darwin':
+    if _IS_MAC:
         # This will exclude the '._' files  in the
         # tar.gz package for OS X.
         os.environ["COPYFILE_DISABLE"] = "1"
@@ -395,6 +475,8 @@ def init(ceate_new_uuid):
         else:
             success = False
             print('ERROR 4: The {} key does not exist in {}'.format(password_key, settings_file))
+
+        g_dev_client_use_sftp = config[sdk_key].getboolean(sftp_key, fallback=False)
     else:
         success = False
         print('ERROR 5: The {} section does not exist in {}'.format(sdk_key, settings_file))
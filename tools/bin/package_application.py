@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import configparser
 import datetime
+import gzip
 import hashlib
+import io
 import json
+import mmap
 import os
-import re
 import shutil
 import subprocess
 import sys
 import uuid
 import tarfile
-import gzip
 from OpenSSL import crypto
 
 META_DATA_FOLDER = 'METADATA'
@@ -19,35 +21,63 @@ CONFIG_FILE = 'package.ini'
 SIGNATURE_FILE = 'SIGNATURE.DS'
 MANIFEST_FILE = 'MANIFEST.json'
 
-BYTE_CODE_FILES = re.compile('^.*\.(pyc|pyo|pyd)$')
-BYTE_CODE_FOLDERS = re.compile('^(__pycache__)$')
+BYTE_CODE_FILES = ('.pyc', '.pyo', '.pyd')
+BYTE_CODE_FOLDER = '__pycache__'
+# Script files that must not contain carriage returns (\r).
+CR_SCAN_FILES = ('.py', '.sh')
+
+# The host OS does not change while running so check it once.
+IS_WIN = sys.platform == 'win32'
 
 
-def file_checksum(hash_func=hashlib.sha256, file=None):
+def file_checksum(hash_func=hashlib.sha256, file=None, reject_cr=False):
     h = hash_func()
-    buffer_size = h.block_size * 64
+    buffer_size = 1 << 20
 
     with open(file, 'rb') as f:
-        for buffer in iter(lambda: f.read(buffer_size), b''):
-            h.update(buffer)
+        if reject_cr and os.fstat(f.fileno()).st_size > 0:
+            # Map the file so it can be scanned and hashed without copying it.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b'\r') != -1:
+                    raise Exception('Carriage return (\\r) found in file %s' % file)
+                h.update(mm)
+        else:
+            for buffer in iter(lambda: f.read(buffer_size), b''):
+                h.update(buffer)
     return h.hexdigest()
 
 
-def hash_dir(target, hash_func=hashlib.sha256):
-    hashed_files = {}
+def hash_dir(target, hash_func=hashlib.sha256, exclude=()):
+    files_to_hash = []
+    # Files left out of the manifest still go into the archive, so
+    # their scripts must be checked for carriage returns too.
+    files_to_check = []
     for path, d, f in os.walk(target):
+        # Skip excluded folders in the target root (i.e. METADATA)
+        if path == target:
+            d[:] = [x for x in d if x not in exclude]
         for fl in f:
             if not fl.startswith('.') and not os.path.basename(path).startswith('.'):
                 # we need this be LINUX fashion!
-                if sys.platform == "win32":
+                if IS_WIN:
                     # swap the network\\tcp_echo to be network/tcp_echo
                     fully_qualified_file = path.replace('\\', '/') + '/' + fl
                 else:  # else allow normal method
                     fully_qualified_file = os.path.join(path, fl)
-                hashed_files[fully_qualified_file[len(target) + 1:]] =\
-                    file_checksum(hash_func, fully_qualified_file)
+                files_to_hash.append((fully_qualified_file, fl.endswith(CR_SCAN_FILES)))
             else:
                 print("Did not include {} in the App package.".format(fl))
+                if fl.endswith(CR_SCAN_FILES):
+                    files_to_check.append(os.path.join(path, fl))
+
+    # hashlib releases the GIL while hashing so the files can be
+    # read and hashed in parallel threads.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        checksums = ex.map(lambda x: file_checksum(hash_func, x[0], x[1]), files_to_hash)
+        hashed_files = {fully_qualified_file[len(target) + 1:]: checksum
+                        for (fully_qualified_file, _), checksum in zip(files_to_hash, checksums)}
+        # Only the carriage return check matters, the checksums are unused.
+        list(ex.map(lambda x: file_checksum(hash_func, x, True), files_to_check))
 
     return hashed_files
 
@@ -55,26 +85,20 @@ def hash_dir(target, hash_func=hashlib.sha256):
 def pack_package(app_root, app_name):
     print('app_root: {}'.format(app_root))
     print('app_name: {}'.format(app_name))
-    print("pack TAR:%s.tar" % app_name)
-    tar_name = "{}.tar".format(app_name)
-    tar = tarfile.open(tar_name, 'w')
-    tar.add(app_root, arcname=os.path.basename(app_root))
-    tar.close()
-
-    print("gzip archive:%s.tar.gz" % app_name)
+    print("pack TAR.GZ:%s.tar.gz" % app_name)
     gzip_name = "{}.tar.gz".format(app_name)
-    with open(tar_name, 'rb') as f_in:
-        with gzip.open(gzip_name, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
-    if os.path.isfile(tar_name):
-        os.remove(tar_name)
+    # tarfile writes in small blocks so buffer them before they reach
+    # gzip, which then compresses the archive in 1 MiB chunks.
+    with open(gzip_name, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as gz, \
+            io.BufferedWriter(gz, buffer_size=1 << 20) as buf, \
+            tarfile.open(fileobj=buf, mode='w') as tar:
+        tar.add(app_root, arcname=os.path.basename(app_root))
 
 
-def create_signature(meta_data_folder, pkey):
-    manifest_file = os.path.join(meta_data_folder, MANIFEST_FILE)
+def create_signature(meta_data_folder, pkey, manifest_bytes):
     with open(os.path.join(meta_data_folder, SIGNATURE_FILE), 'wb') as sf:
-        checksum = file_checksum(hashlib.sha256, manifest_file).encode('utf-8')
+        checksum = hashlib.sha256(manifest_bytes).hexdigest().encode('utf-8')
         if pkey:
             sf.write(crypto.sign(pkey, checksum, 'sha256'))
         else:
@@ -94,11 +118,13 @@ def clean_manifest_folder(app_metadata_folder):
 
 def clean_bytecode_files(app_root):
     for path, dirs, files in os.walk(app_root):
-        for file in filter(lambda x: BYTE_CODE_FILES.match(x), files):
-            os.remove(os.path.join(path, file))
-        for d in filter(lambda x: BYTE_CODE_FOLDERS.match(x), dirs):
-            shutil.rmtree(os.path.join(path, d))
-    pass
+        for file in files:
+            if file.endswith(BYTE_CODE_FILES):
+                os.remove(os.path.join(path, file))
+        for d in dirs:
+            if d == BYTE_CODE_FOLDER:
+                shutil.rmtree(os.path.join(path, d))
+        dirs[:] = [d for d in dirs if d != BYTE_CODE_FOLDER]
 
 
 def package_application(app_root, pkey):
@@ -151,12 +177,13 @@ def package_application(app_root, pkey):
         data['pmf'] = pmf
         data['app'] = app
 
-        app['files'] = hash_dir(app_root)
+        app['files'] = hash_dir(app_root, exclude={META_DATA_FOLDER})
 
-        with open(app_manifest_file, 'w') as f:
-            f.write(json.dumps(data, indent=4, sort_keys=True))
+        manifest_bytes = json.dumps(data, indent=4, sort_keys=True).encode('utf-8')
+        with open(app_manifest_file, 'wb') as f:
+            f.write(manifest_bytes)
 
-        create_signature(app_metadata_folder, pkey)
+        create_signature(app_metadata_folder, pkey, manifest_bytes)
 
         pack_package(app_root, section)
 